@@ -3,12 +3,13 @@ import smartsheet
 from smartsheet.exceptions import ApiError
 from smartsheet_grid import grid
 import requests
-import json
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import orjson
 import time
-from globals import bamb_token_base64_Coby, bamb_token_base64, smartsheet_token
-from globals import smartsheet_token
+from concurrent.futures import ThreadPoolExecutor, wait
 from logger import ghetto_logger
-import xml.etree.ElementTree as ET
+from lxml import etree as ET
 #endregion
 
 class HistoricBambooUpdater():
@@ -23,12 +24,16 @@ class HistoricBambooUpdater():
         - pull_report_682: Fetches a specific BambooHR report with detailed employee data.
         - extract_employee_id_list: Extracts a list of employee IDs and their names.
         - pullnclean_employement_status_table: Fetches and transforms employment status data from BambooHR.
+        - sort_events: Sorts an employee's employment status rows by date.
+        - parse_employement_status_xml: Parses the XML form of the employment status table (fallback for the JSON response).
         - query_empl_directory: Queries the employee directory using an ID and returns specific field value.
-        - api_original_hire_date: Fetches the "Original Hire Date" for a given employee ID.
-        - api_sage_id: Fetches the Sage ID for a given employee ID.
+        - pull_custom_report: Fetches a BambooHR custom report with the given fields for every employee.
+        - fetch_employee_api_fields: Pulls Sage IDs and Original Hire Dates for all employees via custom reports.
+        - log_missing_report_ids: Logs status table ids that the custom reports did not cover.
         - get_original_hire_date: Computes the correct original hire date from possibly inconsistent data.
         - get_date: Determines the date of a specific employment event based on its occurrence.
         - arrange_posting_data: Structures the data in preparation for posting to Smartsheet.
+        - post_hist / post_recog: Post the data (and update stamp) to the historic data / recognition sheets.
         - run: Executes the primary sequence of tasks: fetching, transforming, and posting data.
 
     Usage:
@@ -42,7 +47,9 @@ class HistoricBambooUpdater():
         self.smartsheet_token=config.get('smartsheet_token')
         self.bamb_token=config.get('bamb_token_base64')
         self.bamb_token2=config.get('bamb_token_base64_Coby')
-        grid.token=smartsheet_token
+        self._bamb_session = self.build_bamb_session(self.bamb_token)
+        self._bamb_session2 = self.build_bamb_session(self.bamb_token2)
+        grid.token=self.smartsheet_token
         self.smart = smartsheet.Smartsheet(access_token=self.smartsheet_token)
         self.smart.errors_as_exceptions(True)
         self.start_time = time.time()
@@ -51,79 +58,89 @@ class HistoricBambooUpdater():
         self.annirecog_grid=grid(config.get('anni_recognition_sheetid'))
         
 #region grab-data
+    def build_bamb_session(self, token):
+        '''one keep-alive session (pooled connections + retries on rate limit/gateway errors) so each bamboo call doesn't redo the tcp/tls handshake'''
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=32,
+            pool_maxsize=32,
+            # POST is added so the custom report calls get retried too (urllib3 skips it by default)
+            max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 502, 503, 504], allowed_methods=Retry.DEFAULT_ALLOWED_METHODS | {"POST"}))
+        session.mount("https://", adapter)
+        session.headers.update({"authorization": f"Basic {token}"})
+        return session
     def pull_report_649(self):
         '''report 682 has all the parameters designed for this system (LMS:IT *DON'T DELETE/CHANGE*)'''
         url = "https://api.bamboohr.com/api/gateway.php/dowbuilt/v1/reports/649?format=JSON&onlyCurrent=true"
-        headers = {"authorization": f"Basic {self.bamb_token}"}
-        response = requests.get(url, headers=headers)
-        hris_data=json.loads(response.text).get('employees')
+        response = self._bamb_session.get(url)
+        hris_data=orjson.loads(response.content).get('employees')
         return hris_data
     def extract_employee_id_list(self):
         '''the employement status is id and then statuses, this employee id list allows us to map each id to the empl name'''
         self.log.log('Pulling BambooHr Data...')
         self.empl_directory = self.pull_report_649()
+        # id -> employee record, so lookups don't have to scan the whole directory
+        # (keys are str so they line up w/ the status table ids whether bamboo sent those as json or xml)
+        self._empl_by_id = {str(employee.get('id')): employee for employee in self.empl_directory}
         employee_id_list = [{'name': F"{employee.get('firstName')} {employee.get('lastName')}", 'id':employee.get('id')} for employee in self.empl_directory]
         return employee_id_list 
     def pullnclean_employement_status_table(self):
-        '''messy func which gets employement status table as html, and then uses Element Tree to mine the data and clean it into a list of dictionaries'''
+        '''gets employement status table as json (bamboo's shape is {'employees': {<empl id>: {'lastChanged':..., 'rows': [<row dict>, ...]}}}) and cleans it into dictionaries ({'id': <empl id>, 'data': [<row dict>, ...]}),
+        falls back to the xml parser if bamboo doesn't hand back json
+        this is a generator (one dict per employee), list() it to get the table'''
         url = "https://api.bamboohr.com/api/gateway.php/dowbuilt/v1/employees/changed/tables/employmentStatus?since=2000-01-01T11%3A54%3A00Z"
-        headers = {"authorization": f"Basic {self.bamb_token}"}
-        response = requests.get(url, headers=headers)
+        # streamed, so the xml fallback can be parsed straight off the socket instead of being buffered whole first
+        # (with block, so the pooled connection is released even if parsing fails partway)
+        with self._bamb_session.get(url, headers={"accept": "application/json"}, stream=True) as response:
+            if 'json' not in response.headers.get('content-type', ''):
+                response.raw.decode_content = True
+                yield from self.parse_employement_status_xml(response.raw)
+                return
 
-        root = ET.fromstring(response.text)
-
-        result = {
-            "table": {
-                "@id": root.attrib['id'],
-                "employee": []
-            }
-        }
-
-        for employee in root.findall('employee'):
-            emp_data = {
-                "@id": employee.attrib['id'],
-                "@lastChanged": employee.attrib['lastChanged'],
-                "row": []
-            }
-            for row in employee.findall('row'):
-                row_data = {}
-                for field in row.findall('field'):
-                    field_id = field.attrib['id']
-                    row_data[field_id] = field.text
-                emp_data["row"].append(row_data)
-            result["table"]["employee"].append(emp_data)
-        
-        empl_stat_data = [{'id':empl.get('@id'), 'data':empl.get('row')} for empl in result.get('table').get('employee')]
-        return empl_stat_data
+            employees = orjson.loads(response.content).get('employees') or {}
+        for id, employee in employees.items():
+            yield {'id': str(id), 'data': self.sort_events(employee.get('rows') or [])}
+    def sort_events(self, rows):
+        '''bamboo doesn't promise the status rows come back in date order, and the hire/termination counting depends on it, so each employee gets sorted once here
+        (undated/0000-00-00 rows sort first, which is where get_original_hire_date looks for them)'''
+        return sorted(rows, key=lambda row: row.get('date') or '')
+    def parse_employement_status_xml(self, source):
+        '''streams the xml version of the employement status table w/ lxml iterparse, yielding the same dictionaries as pullnclean_employement_status_table
+        source is a file-like object (the raw response stream)'''
+        for _, employee in ET.iterparse(source, events=("end",), tag="employee"):
+            rows = [{field.get('id'): field.text for field in row.findall('field')} for row in employee.findall('row')]
+            yield {'id': employee.get('id'), 'data': self.sort_events(rows)}
+            # free the parsed employee (and the siblings before it) so the tree doesn't keep growing
+            employee.clear()
+            while employee.getprevious() is not None:
+                del employee.getparent()[0]
 #endregion
 #region prep posting
     def query_empl_directory(self, id, search_str_key):
         '''we got employee directory from report 682, so instead of doing api call, we can just look through our data dict to find some fields'''
-        for empl in self.empl_directory:
-            if empl['id'] == id:
-                return empl[search_str_key]
-    def api_original_hire_date(self, id):
-        '''looks specifically for Original Hire Date Field, which is used inconsistently'''
-        url = f"https://api.bamboohr.com/api/gateway.php/dowbuilt/v1/employees/{id}/?fields=originalHireDate&onlyCurrent=true"
-
-        headers = {
-            "accept": "application/json",
-            "authorization": f"Basic {self.bamb_token}"
-        }
-
-        response = requests.get(url, headers=headers)
-        resp_dict = json.loads(response.content.decode('utf-8'))
-        return resp_dict.get("originalHireDate")
-    def api_sage_id(self, id):
-        '''grabs sage ID'''
-        url = f"https://api.bamboohr.com/api/gateway.php/dowbuilt/v1/employees/{id}/?fields=customSageID&onlyCurrent=true"
-        headers = {
-            "accept": "application/json",
-            "authorization": f"Basic {self.bamb_token2}"
-        }
-        response = requests.get(url, headers=headers)
-        resp_dict = json.loads(response.content.decode('utf-8'))
-        return resp_dict.get('customSageID')
+        return self._empl_by_id.get(str(id), {}).get(search_str_key)
+    def pull_custom_report(self, fields, session):
+        '''pulls a bamboo custom report w/ the given fields for every employee in one POST, instead of one GET per employee
+        (no onlyCurrent, the status table goes back to former employees and they need these fields too)'''
+        url = "https://api.bamboohr.com/api/gateway.php/dowbuilt/v1/reports/custom?format=JSON"
+        response = session.post(url, json={"title": "histdata", "fields": ["id"] + fields}, headers={"accept": "application/json"})
+        # a 403 (token w/o custom report access) or 429 should fail loudly, not come back as an empty report
+        response.raise_for_status()
+        return orjson.loads(response.content).get('employees') or []
+    def fetch_employee_api_fields(self):
+        '''pulls the Original Hire Date (used inconsistently, only needed when the status table says 0000-00-00) and sage id for every employee as bulk reports
+        sage id needs the second token, so it gets its own report'''
+        hire_report = self.pull_custom_report(["originalHireDate"], self._bamb_session)
+        sage_report = self.pull_custom_report(["customSageID"], self._bamb_session2)
+        self.original_hire_date_dict = {str(empl.get('id')): empl.get('originalHireDate') for empl in hire_report}
+        self.sage_id_dict = {str(empl.get('id')): empl.get('customSageID') for empl in sage_report}
+    def log_missing_report_ids(self):
+        '''the status table can have ids the bulk reports don't (ex former employees), those rows would post w/o a sage id / hire date, so log which ones'''
+        stat_ids = {empl.get('id') for empl in self.empl_stat_data}
+        for field, report_dict in (("Sage Id", self.sage_id_dict), ("Original Hire Date", self.original_hire_date_dict)):
+            missing = sorted(stat_ids - report_dict.keys())
+            if missing:
+                self.log.log(f"   {len(missing)} status table ids missing from the {field} report: {missing}")
     def get_original_hire_date(self, input):
         """
         Get the correct original hire date, as the input data is not clean/easy to read.
@@ -134,21 +151,21 @@ class HistoricBambooUpdater():
         {'date': '2019-01-24', 'employmentStatus': 'Terminated'}],
         """
         input_data = input.get('data')
+        if not input_data:
+            return ""
 
         if input_data[0].get('date') ==  "0000-00-00":
-            original_hiredate = self.api_original_hire_date(input.get('id'))
+            # the Original Hire Date field was pulled for everyone up front, so this is a dict lookup not an api call
+            original_hiredate = self.original_hire_date_dict.get(input.get('id'))
         else:
             original_hiredate = input_data[0].get('date')
 
-        # Attempt to get the second hire date, and handle possible IndexError
-        try:
+        # if there's a second event, it wins when it is an earlier (non termination) hire
+        if len(input_data) > 1:
             second_hiredate = input_data[1].get('date')
-            if input_data[1].get('employmentStatus') != "Terminated" and second_hiredate < original_hiredate:
+            if input_data[1].get('employmentStatus') != "Terminated" and second_hiredate and (not original_hiredate or second_hiredate < original_hiredate):
                 return second_hiredate
-        except IndexError:
-            # If there's no second event, pass so it can return original_diredate
-            pass
-        
+
         return original_hiredate
     def get_date(self, input_data, param_index, search_value):
         """
@@ -161,7 +178,7 @@ class HistoricBambooUpdater():
         term_count = 0  # Counter for occurrences of termination
 
         for event in input_data.get('data'):
-            status = event.get('employmentStatus')
+            status = event.get('employmentStatus') or ""
             date = event.get('date')
 
             # Check for any form of termination in the status, if so add to the counter. then return value if its the correct termination
@@ -175,49 +192,107 @@ class HistoricBambooUpdater():
                 return date
 
         return ""
+    def _extract_dates(self, empl):
+        '''same termination-counter logic as get_date, but walks the employee's events once and returns every date arrange_posting_data needs
+        (terminations are keyed by their occurrence, hires by how many terminations came before them)'''
+        terminations = {}
+        hires = {}
+        term_count = 0
+
+        for event in empl.get('data'):
+            # plain substring test on purpose (a set of exact labels is a bit faster, but any "...Terminated" label left off the set would stop counting)
+            status = event.get('employmentStatus') or ""
+            date = event.get('date')
+
+            if 'erminated' in status:
+                term_count += 1
+                terminations[term_count] = date
+                # nothing after the third termination gets posted
+                if term_count == 3:
+                    break
+            elif term_count not in hires:
+                hires[term_count] = date
+
+        return {
+            'orig_hire': self.get_original_hire_date(empl),
+            'term1': terminations.get(1, ""),
+            'hire1': hires.get(1, ""),
+            'term2': terminations.get(2, ""),
+            'hire2': hires.get(2, ""),
+            'term3': terminations.get(3, ""),
+        }
     def arrange_posting_data(self):
-        # Constructing posting_data list 20 mins w/ department
-        self.log.log(f'Arranging {len(self.empl_stat_data)} Posting records (this will take time)')
+        self.log.log(f'Arranging {len(self.empl_stat_data)} Posting records')
         posting_data = []
         for i, empl in enumerate(self.empl_stat_data):
             # for testing
             # if i < 200:
+            id = empl.get('id')
+            # employees w/ status history but no directory record still get a row (named "None None" like before, the recognition sheet matches rows on Name)
+            emp = self._empl_by_id.get(id, {})
+            first, last = emp.get('firstName'), emp.get('lastName')
+            dates = self._extract_dates(empl)
             posting_data.append({
-                'Name': f"{self.query_empl_directory(empl.get('id'), 'firstName')} {self.query_empl_directory(empl.get('id'), 'lastName')}",
-                'Id': empl.get('id'),
-                'HRIS Original Hire': self.get_date(empl, 0, "Original Hire"),
-                'HRIS Original Termination': self.get_date(empl, 1, "Terminated"),
-                'HRIS Rehire': self.get_date(empl, 1, "Hire"),
-                'HRIS Retermination': self.get_date(empl, 2, "Terminated"),
-                'HRIS Final Hire': self.get_date(empl, 2, "Hire"),
-                'HRIS Final Termination': self.get_date(empl, 3, "Terminated"),
-                'Sage Id': self.api_sage_id(empl.get('id')),
-                'Location': self.query_empl_directory(empl.get('id'), 'location'),
-                'Job Title': self.query_empl_directory(empl.get('id'), 'jobTitle'),
-                'Department': self.query_empl_directory(empl.get('id'), 'department'),
-                'Work Email': self.query_empl_directory(empl.get('id'), 'workEmail'),
+                'Name': f"{first} {last}",
+                'Id': id,
+                'HRIS Original Hire': dates['orig_hire'],
+                'HRIS Original Termination': dates['term1'],
+                'HRIS Rehire': dates['hire1'],
+                'HRIS Retermination': dates['term2'],
+                'HRIS Final Hire': dates['hire2'],
+                'HRIS Final Termination': dates['term3'],
+                'Sage Id': self.sage_id_dict.get(id),
+                'Location': emp.get('location'),
+                'Job Title': emp.get('jobTitle'),
+                'Department': emp.get('department'),
+                'Work Email': emp.get('workEmail'),
             })
-            if int(i) % 100 == 0 and i != 0:
+            if i % 100 == 0 and i != 0:
                 self.log.log(f"   Records {i-100}-{i} Arranged.")
         return posting_data
 #endregion
+#region post
+    def post_hist(self):
+        '''posting for Powerbi re: ticket data'''
+        self.histdata_grid.post_new_rows(self.posting_data, post_fresh=True)
+        self.histdata_grid.handle_update_stamps()
+    def post_recog(self):
+        '''posting for Recognition Smartsheet re: bonuses/shouts/swag'''
+        self.annirecog_grid.update_rows(self.posting_data, "Name")
+        self.annirecog_grid.handle_update_stamps()
+#endregion
 
     def run(self):
         '''runs main script as intended'''
-        self.employee_id_list = self.extract_employee_id_list()
-        self.empl_stat_data = self.pullnclean_employement_status_table()
+        # the bamboo pulls don't depend on each other, so they run side by side (all network wait)
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            employee_id_list = executor.submit(self.extract_employee_id_list)
+            # list()'d inside the worker so the request + parse happen on that thread, not when the generator is read
+            empl_stat_data = executor.submit(lambda: list(self.pullnclean_employement_status_table()))
+            api_fields = executor.submit(self.fetch_employee_api_fields)
+            self.employee_id_list = employee_id_list.result()
+            self.empl_stat_data = empl_stat_data.result()
+            api_fields.result()
+        self.log_missing_report_ids()
         self.posting_data = self.arrange_posting_data()
         self.log.log('Posting Data...')
-        # posting for Powerbi re: ticket data
-        self.histdata_grid.post_new_rows(self.posting_data, post_fresh=True)
-        self.histdata_grid.handle_update_stamps()
-        # posting for Recognition Smartsheet re: bonuses/shouts/swag
-        self.annirecog_grid.update_rows(self.posting_data, "Name")
-        self.annirecog_grid.handle_update_stamps()
+        # the two sheets don't share anything (each grid has its own smartsheet client), so they post side by side
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            hist_post = executor.submit(self.post_hist)
+            recog_post = executor.submit(self.post_recog)
+            # wait on both before raising, so if both sheets fail neither error gets dropped
+            wait([hist_post, recog_post])
+        errors = [(name, post.exception()) for name, post in (("historic data", hist_post), ("recognition", recog_post)) if post.exception() is not None]
+        for name, error in errors:
+            self.log.log(f"Posting to the {name} sheet failed: {error!r}")
+        if errors:
+            raise errors[0][1]
         self.log.log('~Fin~')
 
 
 if __name__ == "__main__":
+    # tokens are only loaded when run as a script, so importing this module doesn't need globals.py
+    from globals import bamb_token_base64_Coby, bamb_token_base64, smartsheet_token
     config = {
         'smartsheet_token':smartsheet_token,
         'bamb_token_base64_Coby':bamb_token_base64_Coby, 
@@ -13,6 +13,8 @@ class ghetto_logger:
         self.first_use=True
         self.first_line_stamp  = f"{self.now}  {title}--"
         self.start_time = time.time()
+        # log file isn't opened until the first log, then the handle is kept for the rest of the run
+        self.file = None
         if os.name == 'nt':
             current_file_path = os.path.abspath(__file__)
             directory = os.path.dirname(current_file_path)
@@ -35,23 +37,31 @@ class ghetto_logger:
         # so lists/dictionaries/etc can be logged without issue
         text = str(text)
 
-        function_name = inspect.currentframe().f_back.f_code.co_name
-        
-        try:
-            module_name = inspect.getmodule(inspect.stack()[1][0]).__name__
-        except:
-            module_name = "__main__"
+        # only the caller's frame is needed, inspect.stack() would build (and read source for) the whole stack on every log
+        caller = inspect.currentframe().f_back
+        function_name = caller.f_code.co_name
+        module_name = caller.f_globals.get('__name__', "__main__")
 
         func_stamp = f"{self.timestamp()}  {module_name}.{function_name}(): "
 
         if self.print == True:
             print(f"{func_stamp} {text}")
 
-        with open(self.path, mode=mode) as file:
-            if self.first_use == True:
-                file.write("\n" + "\n"+ self.first_line_stamp)
-                self.first_use = False
-            if self.first_use == False and type == "paragraph":
-                file.write(text)
-            elif self.first_use == False:
-                file.write("\n  " + func_stamp + text)
\ No newline at end of file
+        file = self.get_file(mode)
+        if self.first_use == True:
+            file.write("\n" + "\n"+ self.first_line_stamp)
+            self.first_use = False
+        if self.first_use == False and type == "paragraph":
+            file.write(text)
+        elif self.first_use == False:
+            file.write("\n  " + func_stamp + text)
+        # flushed per log so a crashed/killed run still leaves its log behind
+        file.flush()
+
+    def get_file(self, mode="a"):
+        '''opens the log file on first use and reuses that handle after, only reopens if a non-append mode (ex "w") is asked for'''
+        if self.file is None or mode != "a":
+            if self.file is not None:
+                self.file.close()
+            self.file = open(self.path, mode=mode)
+        return self.file
\ No newline at end of file
@@ -1,8 +1,19 @@
 #!/usr/bin/env python
 
 import smartsheet
+from smartsheet.exceptions import ApiError
 import pandas as pd
 import datetime
+import json
+import os
+import re
+import threading
+import functools
+
+@functools.lru_cache(maxsize=None)
+def exclusion_pattern(exclusion_string):
+    '''compiled (once per exclusion_string) character class matching any of the given characters literally'''
+    return re.compile(f'[{re.escape(exclusion_string)}]')
 
 class grid:
     """
@@ -33,6 +44,9 @@ class grid:
     fetch_content() -> None:
         Fetches the sheet content from Smartsheet and sets various attributes like columns, rows, row IDs, etc.
 
+    fetch_summary_fields() -> None:
+        Fetches the summary fields and indexes them by title, without building a DataFrame.
+
     fetch_summary_content() -> None:
         Fetches and constructs a summary DataFrame for summary columns.
 
@@ -46,7 +60,7 @@ class grid:
         Deletes all rows in the current sheet.
 
     post_new_rows(posting_data: List[Dict[str, Any]], post_fresh: bool=False, post_to_top: bool=False) -> None:
-        Posts new rows to the Smartsheet. Can optionally delete the whole sheet before posting or set the position of the new rows.
+        Posts new rows to the Smartsheet in chunks of post_chunk_size. Can optionally delete the whole sheet before posting or set the position of the new rows.
 
     update_rows(posting_data: List[Dict[str, Any]], primary_key: str):
         Updates rows that can be updated, posts rows that do not map to the sheet.
@@ -62,6 +76,11 @@ class grid:
     """
 
     token = None
+    # smartsheet's per-request row limit for bulk adds
+    post_chunk_size = 500
+    # summary field ids from past runs, {"<grid id>:<field title>": <summary field id>}
+    sum_id_cache_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sum_id_cache.json")
+    _sum_id_cache_lock = threading.Lock()
 
     def __init__(self, grid_id):
         self.grid_id = grid_id
@@ -90,45 +109,38 @@ class grid:
         if self.token == None:
             return "MUST SET TOKEN"
         else:
-            self.grid_content = (self.smart.Sheets.get_sheet(self.grid_id)).to_dict()
-            self.grid_name = (self.grid_content).get("name")
-            self.grid_url = (self.grid_content).get("permalink")
+            content = self.grid_content = (self.smart.Sheets.get_sheet(self.grid_id)).to_dict()
+            rows = content.get("rows") or []
+            columns = content.get("columns") or []
+            self.grid_name = content.get("name")
+            self.grid_url = content.get("permalink")
             # this attributes pulls the column headers
-            self.grid_columns = [i.get("title") for i in (self.grid_content).get("columns")]
-            # note that the grid_rows is equivelant to the cell's 'Display Value'
-            self.grid_rows = []
-            if (self.grid_content).get("rows") == None:
-                self.grid_rows = []
-            else:
-                for i in (self.grid_content).get("rows"):
-                    b = i.get("cells")
-                    c = []
-                    for i in b:
-                        l = i.get("displayValue")
-                        m = i.get("value")
-                        if l == None:
-                            c.append(m)
-                        else:
-                            c.append(l)
-                    (self.grid_rows).append(c)
-            
+            self.grid_columns = [column.get("title") for column in columns]
+            # note that the grid_rows is equivelant to the cell's 'Display Value' (falling back to 'value' when there is no display value)
+            self.grid_rows = [
+                [cell.get("value") if cell.get("displayValue") is None else cell.get("displayValue") for cell in row.get("cells")]
+                for row in rows]
+
             # resulting fetched content
-            self.grid_rows = self.grid_rows
-            if (self.grid_content).get("rows") == None:
-                self.grid_row_ids = []
-            else:
-                self.grid_row_ids = [i.get("id") for i in (self.grid_content).get("rows")]
-            self.grid_column_ids = [i.get("id") for i in (self.grid_content).get("columns")]
+            self.grid_row_ids = [row.get("id") for row in rows]
+            self.grid_column_ids = [column.get("id") for column in columns]
             self.df = pd.DataFrame(self.grid_rows, columns=self.grid_columns)
             # Should be row_id intead of id as that is less likely to be taken name space!!!
             self.df["id"]=self.grid_row_ids
             self.column_df = self.get_column_df()
+    def fetch_summary_fields(self):
+        '''pulls the summary fields as json and indexes them by title (in self._summary_by_title), w/o building a df'''
+        if self.token == None:
+            return "MUST SET TOKEN"
+        else:
+            self.grid_content = (self.smart.Sheets.get_sheet_summary_fields(self.grid_id)).to_dict()
+            self._summary_by_title = {field.get('title'): field for field in (self.grid_content).get("data") or []}
     def fetch_summary_content(self):
         '''builds the summary df for summary columns'''
         if self.token == None:
             return "MUST SET TOKEN"
         else:
-            self.grid_content = (self.smart.Sheets.get_sheet_summary_fields(self.grid_id)).to_dict()
+            self.fetch_summary_fields()
             # this attributes pulls the column headers
             self.summary_params=['title','createdAt', 'createdBy', 'displayValue', 'formula', 'id', 'index', 'locked', 'lockedForUser', 'modifiedAt', 'modifiedBy', 'objectValue', 'type']
             self.grid_rows = []
@@ -154,8 +166,9 @@ class grid:
         if self.token == None:
             return "MUST SET TOKEN"
         else:
-            regex_string = f'[{exclusion_string}]'
-            self.column_reduction =  self.column_df[self.column_df['title'].str.contains(regex_string,regex=True)==False]
+            # na=False keeps the mask a plain bool series (titles that are missing just aren't excluded)
+            excluded = self.column_df['title'].str.contains(exclusion_pattern(exclusion_string), regex=True, na=False)
+            self.column_reduction = self.column_df.loc[~excluded]
             self.reduced_column_ids = list(self.column_reduction.id)
             self.reduced_column_names = list(self.column_reduction.title)
 #endregion
@@ -168,80 +181,112 @@ class grid:
         filtered column title list is a list of column title str to prep for posting (if you are not posting to all columns)
         [NOT USED INDEPENDENTLY, BUT USED INSIDE OF POST_NEW_ROWS]'''
 
-        column_df = self.get_column_df()
+        # fetch_content already pulled the columns, so only hit the api if it hasn't run yet
+        column_df = self.column_df if getattr(self, 'column_df', None) is not None else self.get_column_df()
 
         if filtered_column_title_list == "all_columns":
             filtered_column_title_list = column_df['title'].tolist()
     
-        self.column_id_dict = {title: column_df.loc[column_df['title'] == title]['id'].tolist()[0] for title in filtered_column_title_list}
+        # a title that isn't on the sheet raises KeyError
+        title_to_id = dict(zip(column_df['title'], column_df['id']))
+        self.column_id_dict = {title: title_to_id[title] for title in filtered_column_title_list}
     def delete_all_rows(self):
-        '''deletes up to 400 rows in 200 row chunks by grabbing row ids and deleting them one at a time in a for loop
+        '''deletes every row in 200 row chunks by grabbing row ids and deleting them one chunk at a time
+        (one after another, smartsheet rejects concurrent writes to the same sheet)
         [NOT USED INDEPENDENTLY, BUT USED INSIDE OF POST_NEW_ROWS]'''
         self.fetch_content()
 
-        row_list_del = []
-        for rowid in self.df['id'].to_list():
-            row_list_del.append(rowid)
-            # Delete rows to sheet by chunks of 200
-            if len(row_list_del) > 199:
-                self.smart.Sheets.delete_rows(self.grid_id, row_list_del)
-                row_list_del = []
-        # Delete remaining rows
-        if len(row_list_del) > 0:
-            self.smart.Sheets.delete_rows(self.grid_id, row_list_del) 
+        row_ids = self.df['id'].to_list()
+        for i in range(0, len(row_ids), 200):
+            self.smart.Sheets.delete_rows(self.grid_id, row_ids[i:i + 200])
     def post_new_rows(self, posting_data, post_fresh = False, post_to_top=False):
         '''posts new row to sheet, does not account for various column types at the moment
         posting data is a list of dictionaries, one per row, where the key is the name of the column, and the value is the value you want to post
         then this function creates a second dictionary holding each column's id, and then posts the data one dictionary at a time (each is a row)
         post_to_top = the new row will appear on top, else it will appear on bottom
         post_fresh = first delete the whole sheet, then post (else it will just update existing sheet)
+        rows go out in chunks of post_chunk_size, one request each: if a chunk fails it raises and the chunks after it are not sent,
+        so the sheet is left partly posted (w/ post_fresh that means partly filled, since every row was already deleted). self.post_response holds the chunks that did go through
         TODO: if using post_to_top==False, I should really delete the empty rows in the sheet so it will properly post to bottom'''
         
         posting_sheet_id = self.grid_id
         column_title_list = list(posting_data[0].keys())
         try:
             self.grab_posting_column_ids(column_title_list)
-        except IndexError:
-            raise ValueError("Index Error reveals that your posting_data dictionary has key(s) that don't match the column names on the Smartsheet")
+        except KeyError:
+            raise ValueError("Key Error reveals that your posting_data dictionary has key(s) that don't match the column names on the Smartsheet")
         if post_fresh:
             self.delete_all_rows()
         
-        rows = []
-
-        for item in posting_data:
-            row = smartsheet.models.Row()
-            row.to_top = post_to_top
-            row.to_bottom= not(post_to_top)
-            for key in self.column_id_dict:
-                if item.get(key) != None:     
-                    row.cells.append({
-                    'column_id': self.column_id_dict[key],
-                    'value': item[key]
-                    })
-            rows.append(row)
-
-        self.post_response = self.smart.Sheets.add_rows(posting_sheet_id, rows)
+        # rows are built as plain dicts in the api's json shape, skipping the sdk's model validation on every row/cell
+        column_ids = list(self.column_id_dict.items())
+        rows = [
+            {
+                'toTop': post_to_top,
+                'toBottom': not(post_to_top),
+                'cells': [{'columnId': column_id, 'value': item[key]} for key, column_id in column_ids if item.get(key) != None],
+            }
+            for item in posting_data]
+
+        # posted in chunks so no request goes over the row limit, a failed chunk raises and stops the rest (see docstring)
+        # chunks go one after another: smartsheet rejects concurrent writes to the same sheet
+        self.post_response = []
+        for i in range(0, len(rows), self.post_chunk_size):
+            self.post_response.append(self.smart.Sheets.add_rows(posting_sheet_id, rows[i:i + self.post_chunk_size]))
     #endregion
     #region post timestamp
     def handle_update_stamps(self):
-        '''grabs summary id, and then runs the function that posts the date'''
+        '''grabs summary id, and then runs the function that posts the date
+        if this sheet's summary id is cached from an earlier run, it posts straight to it (1 api call instead of fetch + post)'''
         current_date = datetime.date.today()
         formatted_date = current_date.strftime('%m/%d/%y')
 
+        cached_sum_id = self.read_sum_id_cache("Last API Automation")
+        if cached_sum_id is not None:
+            try:
+                self.post_to_summary_field(cached_sum_id, formatted_date)
+                return
+            except ApiError:
+                # field was deleted/recreated since it was cached, look it up again below
+                pass
+
         sum_id = self.grabrcreate_sum_id("Last API Automation", "DATE")
         self.post_to_summary_field(sum_id, formatted_date)
+        self.write_sum_id_cache("Last API Automation", sum_id)
+    def read_sum_id_cache(self, field_name_str):
+        '''returns the cached summary field id for this sheet + field title, or None if it hasn't been cached'''
+        try:
+            with open(self.sum_id_cache_path) as file:
+                return json.load(file).get(f"{self.grid_id}:{field_name_str}")
+        except (OSError, json.JSONDecodeError):
+            return None
+    def write_sum_id_cache(self, field_name_str, sum_id):
+        '''saves the summary field id for this sheet + field title (locked, grids can stamp from different threads)
+        best effort: if the file can't be written (ex read-only folder) it's skipped and the next run just looks the id up again'''
+        with self._sum_id_cache_lock:
+            try:
+                with open(self.sum_id_cache_path) as file:
+                    cache = json.load(file)
+            except (OSError, json.JSONDecodeError):
+                cache = {}
+            cache[f"{self.grid_id}:{field_name_str}"] = int(sum_id)
+            try:
+                with open(self.sum_id_cache_path, "w") as file:
+                    json.dump(cache, file, indent=2)
+            except OSError:
+                pass
     def grabrcreate_sum_id(self, field_name_str, sum_type):
         '''checks if there is a DATE summary field called "Last API Automation", if Y, pulls id, if N, creates the field.
         then posts today's date to that field
         [ONLY TESTED FOR DATE FIELDS FOR NOW]'''
-        # First, let's fetch the current summary fields of the sheet
-        self.fetch_summary_content()
+        # First, let's fetch the current summary fields of the sheet (by title, no df needed)
+        self.fetch_summary_fields()
 
         # Check if "Last API Automation" summary field exists
-        automation_field = self.df[self.df['title'] == field_name_str]
+        automation_field = self._summary_by_title.get(field_name_str)
 
         # If it doesn't exist, create it
-        if automation_field.empty:
+        if automation_field is None:
             new_field = smartsheet.models.SummaryField({
                 "title": field_name_str,
                 "type": sum_type
@@ -251,7 +296,7 @@ class grid:
             self.sum_id = response.data[0].id
         else:
             # Extract the ID from the existing field
-            self.sum_id = automation_field['id'].values[0]
+            self.sum_id = automation_field['id']
 
         return self.sum_id
 
@@ -327,8 +372,8 @@ class grid:
         column_title_list = list(posting_data[0].keys())
         try:
             self.grab_posting_column_ids(column_title_list)
-        except IndexError:
-            raise ValueError("Index Error reveals that your posting_data dictionary has key(s) that don't match the column names on the Smartsheet")
+        except KeyError:
+            raise ValueError("Key Error reveals that your posting_data dictionary has key(s) that don't match the column names on the Smartsheet")
         self.update_data = self.grab_posting_row_ids(posting_data, primary_key)
 
         rows = []